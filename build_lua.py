@@ -9,56 +9,93 @@ Steps
 1. Dependencies: checks if installed.
     * Compiler (TDM-GCC) as `gcc`
 2. Clean (in case of previous build).
-3. Download Lua source code.
+3. Download (and verify) Lua source code.
 4. Extract Lua source code.
 5. Build Lua.
 6. Install Lua (currently to os.environ['APPDATA'] + 'Lua')
 """
-import glob
-import logging.config
+import argparse
+import atexit
+import base64
+import email.utils
+import hashlib
+import http
+import http.client
+import logging
 import os
 import platform
 import shutil
+import stat
 import subprocess
+import sys
+import tarfile
+import threading
+import urllib.parse
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import BinaryIO
+from typing import Callable
+from typing import Dict
 from typing import Final
+from typing import FrozenSet
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Set
+from typing import Tuple
+from typing import Union
 
-from log_config import LOGGING_CONFIG
+from log_config import configure_logging
 
 
 # Config
 GCC: Final[str] = 'gcc'
 version: Final[str] = '5.4.3'
-if platform.system() == 'Windows':
+LUA_HOST: Final[str] = 'www.lua.org'
+MAX_REDIRECTS: Final[int] = 5
+REDIRECT_STATUSES: Final[FrozenSet[int]] = frozenset(
+    {
+        http.HTTPStatus.MOVED_PERMANENTLY,
+        http.HTTPStatus.FOUND,
+        http.HTTPStatus.SEE_OTHER,
+        http.HTTPStatus.TEMPORARY_REDIRECT,
+        http.HTTPStatus.PERMANENT_REDIRECT,
+    }
+)
+CHUNK_SIZE: Final[int] = 1024 * 1024
+BUILT_VERSION_FILE: Final[str] = '.built_version'
+HEADERS: Final[FrozenSet[str]] = frozenset(
+    {
+        'luaconf.h',
+        'lua.h',
+        'lualib.h',
+        'lauxlib.h',
+        'lua.hpp',
+    }
+)
+# Known-good SHA-256 digests of the Lua source archives, from lua.org.
+KNOWN_DIGESTS: Final[Dict[str, str]] = {
+    '5.4.3': 'f8612276169e3bfcbcfb8f226195bfc6e466fe13042f1076cbde92b7ec96bbfb',  # noqa: E501
+}
+system: Final[str] = platform.system()
+if system == 'Windows':
     install_directory: Final[Path] = Path(os.environ['APPDATA']) / 'Lua'
-elif platform.system() == 'Linux':
+elif system == 'Linux':
     raise NotImplementedError('Unsupported platform: Linux.')
 else:
     raise NotImplementedError('Unsupported platform: not Windows or Linux.')
 
-logging.config.dictConfig(LOGGING_CONFIG)
 logger = logging.getLogger(__name__)
 
+# Kept open between downloads (keep-alive), see `get_connection`.
+_connections: Dict[Tuple[str, str], http.client.HTTPConnection] = {}
+
 
 def is_executable(executable: str) -> bool:
     """Check if a command is executable."""
     logger.info(f'Checking if {executable} is executable.')
-    try:
-        subprocess.check_call(
-            [executable],
-            shell=False,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
-            stdin=subprocess.DEVNULL,
-        )
-    except FileNotFoundError:
-        return False
-    except subprocess.CalledProcessError:
-        # Installed but requires an argument(s).
-        return True
-
-    return True
+    return shutil.which(executable) is not None
 
 
 def check_dependencies() -> None:
@@ -71,14 +108,177 @@ def check_dependencies() -> None:
         )
 
 
+def _get_proxy(
+    scheme: str, host: str
+) -> Optional[Tuple[str, Optional[int], Dict[str, str]]]:
+    """Get the proxy for a URL from the environment, if any.
+
+    Returns the proxy's host name, port, and the headers authenticating with
+    it (if it has credentials).
+    """
+    proxy: Final[Optional[str]] = urllib.request.getproxies().get(scheme)
+    if not proxy or urllib.request.proxy_bypass(host):
+        return None
+    parts = urllib.parse.urlsplit(
+        proxy if '://' in proxy else f'http://{proxy}'
+    )
+    headers: Dict[str, str] = {}
+    if parts.username is not None:
+        credentials: Final[str] = ':'.join(
+            (
+                urllib.parse.unquote(parts.username),
+                urllib.parse.unquote(parts.password or ''),
+            )
+        )
+        token: Final[str] = base64.b64encode(credentials.encode()).decode()
+        headers['Proxy-Authorization'] = f'Basic {token}'
+    return parts.hostname or '', parts.port, headers
+
+
+def get_connection(scheme: str, host: str) -> http.client.HTTPConnection:
+    """Get the shared connection to a host, reused between downloads.
+
+    Proxies from the environment (e.g. `HTTP_PROXY`) are honoured.
+    """
+    if (scheme, host) not in _connections:
+        connection: http.client.HTTPConnection
+        proxy = _get_proxy(scheme, host)
+        if scheme == 'https':
+            if proxy is None:
+                connection = http.client.HTTPSConnection(host, timeout=30)
+            else:
+                proxy_host, proxy_port, proxy_headers = proxy
+                connection = http.client.HTTPSConnection(
+                    proxy_host, proxy_port, timeout=30
+                )
+                connection.set_tunnel(host, headers=proxy_headers)
+        elif proxy is None:
+            connection = http.client.HTTPConnection(host, timeout=30)
+        else:
+            proxy_host, proxy_port, _ = proxy
+            connection = http.client.HTTPConnection(
+                proxy_host, proxy_port, timeout=30
+            )
+        _connections[(scheme, host)] = connection
+    return _connections[(scheme, host)]
+
+
+def _verified_path(download_path: Path) -> Path:
+    """Path of the SHA-256 sidecar file for a downloaded archive."""
+    return download_path.with_name(f'{download_path.name}.sha256')
+
+
+def sha256_digest(path: Path) -> str:
+    """SHA-256 digest of a file, read in chunks into a reused buffer."""
+    digest = hashlib.sha256()
+    buffer = bytearray(CHUNK_SIZE)
+    view = memoryview(buffer)
+    with open(path, 'rb', buffering=0) as file:
+        while size := file.readinto(buffer):
+            digest.update(view[:size])
+    return digest.hexdigest()
+
+
+def verify_lua(download_path: Path, version: str) -> bool:
+    """Verify downloaded Lua source code against its SHA-256 digest.
+
+    The digest is cached in a sidecar file, and reused as long as the sidecar
+    is not older than the archive.
+    """
+    sidecar_path: Final[Path] = _verified_path(download_path)
+    if (
+        sidecar_path.exists()
+        and sidecar_path.stat().st_mtime >= download_path.stat().st_mtime
+    ):
+        logger.info(f'Using cached digest: {sidecar_path!s}')
+        digest = sidecar_path.read_text().strip()
+    else:
+        logger.info(f'Computing digest: {download_path!s}')
+        digest = sha256_digest(download_path)
+        sidecar_path.write_text(digest)
+
+    expected_digest: Final[Optional[str]] = KNOWN_DIGESTS.get(version)
+    if expected_digest is not None and digest != expected_digest:
+        logger.warning(f'Digest mismatch for {download_path!s}: {digest}')
+        sidecar_path.unlink()
+        return False
+
+    return True
+
+
+def request_lua(
+    version: str, headers: Optional[Dict[str, str]] = None
+) -> http.client.HTTPResponse:
+    """Request Lua source code from the Lua host, following redirects.
+
+    Responds with either 200 (OK), or 304 (Not Modified) for conditional
+    requests.
+    """
+    url: str = f'http://{LUA_HOST}/ftp/lua-{version}.tar.gz'
+    for _ in range(MAX_REDIRECTS + 1):
+        parts = urllib.parse.urlsplit(url)
+        connection = get_connection(parts.scheme, parts.netloc)
+        target: str = urllib.parse.urlunsplit(
+            ('', '', parts.path, parts.query, '')
+        )
+        request_headers: Dict[str, str] = dict(headers or {})
+        # Plain HTTP proxies expect the absolute URL, and their credentials
+        # with each request (HTTPS proxies get them when tunnelling).
+        proxy = _get_proxy(parts.scheme, parts.netloc)
+        if parts.scheme == 'http' and proxy is not None:
+            target = url
+            request_headers.update(proxy[2])
+        connection.request('GET', target, headers=request_headers)
+        response = connection.getresponse()
+        if response.status not in REDIRECT_STATUSES:
+            break
+        response.read()
+        url = urllib.parse.urljoin(url, response.getheader('Location', ''))
+        if urllib.parse.urlsplit(url).scheme not in ('http', 'https'):
+            raise SystemExit(f'Unsupported redirect for Lua {version}: {url}')
+        logger.info(f'Redirected to {url}')
+    else:
+        raise SystemExit(f'Too many redirects for Lua {version}.')
+
+    if response.status == http.HTTPStatus.NOT_MODIFIED:
+        # Finish the (empty) response, so the connection can be reused.
+        response.read()
+    elif response.status != http.HTTPStatus.OK:
+        response.read()
+        raise SystemExit(
+            f'Failed to download Lua {version} with {response.status=}.'
+        )
+    return response
+
+
 def download_lua(version: str) -> Path:
     """Download Lua source code."""
     logger.info(f'Downloading Lua {version}')
-    download_url: Final[str] = f'http://www.lua.org/ftp/lua-{version}.tar.gz'
     download_path: Final[Path] = Path(f'lua-{version}.tar.gz')
 
-    if not Path(download_path).exists():
-        urllib.request.urlretrieve(download_url, download_path)
+    # Revalidate a verified archive, rather than downloading it again.
+    headers: Dict[str, str] = {}
+    if download_path.exists() and verify_lua(download_path, version):
+        headers['If-Modified-Since'] = email.utils.formatdate(
+            download_path.stat().st_mtime, usegmt=True
+        )
+
+    response = request_lua(version, headers)
+    if response.status == http.HTTPStatus.NOT_MODIFIED:
+        logger.info(f'Reusing unmodified {download_path!s}')
+        return download_path
+
+    # Download to a partial file first, so an interrupted download is never
+    # mistaken for a complete one.
+    partial_path: Final[Path] = download_path.with_name(
+        f'{download_path.name}.part'
+    )
+    with open(partial_path, 'wb') as file:
+        shutil.copyfileobj(response, file, length=CHUNK_SIZE)
+    os.replace(partial_path, download_path)
+
+    if not verify_lua(download_path, version):
+        raise SystemExit(f'Downloaded Lua {version} failed verification.')
 
     return download_path
 
@@ -89,20 +289,139 @@ def extract_lua(archive: Path) -> None:
     shutil.unpack_archive(archive)
 
 
+class _HashingReader:
+    """File-like reader computing the SHA-256 digest of what it reads."""
+
+    def __init__(self, file: BinaryIO) -> None:
+        self.file = file
+        self.digest = hashlib.sha256()
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.file.read(size)
+        self.digest.update(data)
+        return data
+
+
+def fetch_and_extract(version: str) -> None:
+    """Download and extract Lua source code, without saving the archive.
+
+    The archive is verified against its known SHA-256 digest while streaming,
+    and the extracted source is removed if it doesn't match.
+    """
+    logger.info(f'Downloading and extracting Lua {version}')
+    reader = _HashingReader(request_lua(version))
+    with tarfile.open(fileobj=reader, mode='r|gz') as archive:
+        if hasattr(tarfile, 'data_filter'):
+            archive.extractall('.', filter='data')
+        else:
+            archive.extractall('.')
+    # Drain any trailing padding, so the whole archive is hashed and the
+    # connection can be reused.
+    while reader.read(CHUNK_SIZE):
+        pass
+
+    digest: Final[str] = reader.digest.hexdigest()
+    expected_digest: Final[Optional[str]] = KNOWN_DIGESTS.get(version)
+    if expected_digest is not None and digest != expected_digest:
+        logger.warning(f'Digest mismatch for Lua {version}: {digest}')
+        clean_lua_source()
+        raise SystemExit(f'Downloaded Lua {version} failed verification.')
+
+
+def _make_writable_and_retry(
+    function: Callable[[str], object],
+    path: str,
+    error: Union[BaseException, Tuple[type, BaseException, object]],
+) -> None:
+    """Clear the read-only flag on a path, and retry removing it.
+
+    Other failures (e.g. listing a directory) are re-raised.
+    """
+    if function not in (os.unlink, os.rmdir):
+        # `onexc` passes the exception, `onerror` passes `sys.exc_info()`.
+        raise error if isinstance(error, BaseException) else error[1]
+    os.chmod(path, stat.S_IWRITE)
+    function(path)
+
+
+def force_rmtree(path: Union[str, Path]) -> None:
+    """Remove a directory tree, including read-only files."""
+    if sys.version_info >= (3, 12):
+        shutil.rmtree(path, onexc=_make_writable_and_retry)
+    else:
+        shutil.rmtree(path, onerror=_make_writable_and_retry)
+
+
 def clean_lua_source() -> None:
     """Clean Lua source code."""
     logger.info('Cleaning Lua source code.')
-    for path in glob.glob('lua-*'):
-        if Path(path).is_dir():
-            logger.info(f'Removing {path} directory.')
-            shutil.rmtree(path)
+    with os.scandir('.') as entries:
+        for entry in entries:
+            if entry.name.startswith('lua-') and entry.is_dir(
+                follow_symlinks=False
+            ):
+                logger.info(f'Removing {entry.name} directory.')
+                force_rmtree(entry.path)
+
+
+def is_built(build_directory: Path, version: str) -> bool:
+    """Check if Lua source code was already built for a version."""
+    built_version_path: Final[Path] = build_directory / BUILT_VERSION_FILE
+    if not built_version_path.exists():
+        return False
+    return built_version_path.read_text() == version
+
+
+def mark_built(build_directory: Path, version: str) -> None:
+    """Mark Lua source code as built for a version."""
+    (build_directory / BUILT_VERSION_FILE).write_text(version)
+
+
+def _prefetch_file(path: str) -> None:
+    """Ask the OS to read a file into the page cache."""
+    with open(path, 'rb') as file:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        else:
+            while file.read(CHUNK_SIZE):
+                pass
+
+
+def prefetch_source(build_directory: Path) -> threading.Thread:
+    """Warm the page cache for Lua source code, in a background thread."""
+
+    def prefetch() -> None:
+        # Best effort, make will read (or fail on) the files itself.
+        try:
+            with os.scandir(build_directory / 'src') as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        _prefetch_file(entry.path)
+        except OSError:
+            pass
+
+    thread = threading.Thread(target=prefetch, daemon=True)
+    thread.start()
+    return thread
 
 
 def build_lua(build_directory: Path) -> None:
     """Build Lua."""
     logger.info(f'Building Lua in {build_directory!s}')
+    jobs_env: Final[str] = os.environ.get(
+        'LUA_BUILD_JOBS', str(os.cpu_count() or 2)
+    )
+    try:
+        jobs: int = int(jobs_env)
+    except ValueError:
+        jobs = 0
+    if jobs < 1:
+        raise SystemExit(
+            f'LUA_BUILD_JOBS must be a positive integer, not {jobs_env!r}.'
+        )
     process = subprocess.Popen(
-        ['mingw32-make', 'PLAT=mingw'],
+        # Keep `PLAT=mingw` last, so make's target parsing is unchanged.
+        ['mingw32-make', f'-j{jobs}', 'PLAT=mingw'],
         cwd=build_directory,
     )
 
@@ -111,20 +430,48 @@ def build_lua(build_directory: Path) -> None:
         raise SystemExit(f'Failed to build Lua with {return_code=}.')
 
 
-def check_lua(lua_executable: str) -> None:
-    """Check if Lua was built."""
+def start_executable(
+    executable: Union[str, Path]
+) -> Optional[subprocess.Popen]:
+    """Start a command without waiting on it, if it can be found."""
+    logger.info(f'Starting {executable!s}.')
+    try:
+        return subprocess.Popen(
+            [os.fspath(executable)],
+            shell=False,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            stdin=subprocess.DEVNULL,
+        )
+    except FileNotFoundError:
+        return None
+
+
+def wait_executable(process: Optional[subprocess.Popen]) -> bool:
+    """Wait on a command from `start_executable`, if it was executable."""
+    if process is None:
+        return False
+    # A non-zero return code means installed but requires an argument(s).
+    process.wait()
+    return True
+
+
+def check_lua(
+    lua_executable: Path, process: Optional[subprocess.Popen]
+) -> None:
+    """Check if Lua was built, waiting on its `start_executable` process."""
 
     # Check Build
-    logger.info(f'Checking {lua_executable}')
-    if not is_executable(lua_executable):
-        raise SystemExit(f'Lua is not executable: {lua_executable}.')
+    logger.info(f'Checking {lua_executable!s}')
+    if not wait_executable(process):
+        raise SystemExit(f'Lua is not executable: {lua_executable!s}.')
 
 
 def clean_distribution(dist_directory: Path) -> None:
     """Clean binary distribution."""
     logger.info(f'Cleaning dist directory: {dist_directory}')
     if dist_directory.exists():
-        shutil.rmtree(dist_directory)
+        force_rmtree(dist_directory)
 
 
 def create_distribution(build_directory: Path, dist_directory: Path) -> None:
@@ -144,56 +491,125 @@ def create_distribution(build_directory: Path, dist_directory: Path) -> None:
     logger.info(
         f'Copying files to dist directory: {build_directory!s} -> {dist_directory!s}'  # noqa: E501
     )
+    jobs: List[Tuple[Union[str, Path], Path]] = []
     for file in (build_directory / 'doc').glob('*.*'):
-        logger.info(f'Copying file: {file!s} -> {doc_directory!s}')
-        shutil.copy2(file, doc_directory)
-    for glob_ in ('*.exe', '*.dll'):
-        for file in (build_directory / 'src').glob(glob_):
-            logger.info(f'Copying file: {file!s} -> {bin_directory!s}')
-            shutil.copy2(file, bin_directory)
-    for header_file in (
-        'luaconf.h',
-        'lua.h',
-        'lualib.h',
-        'lauxlib.h',
-        'lua.hpp',
-    ):
-        logger.info(f'Copying file: {header_file!s} -> {include_directory!s}')
-        shutil.copy2(build_directory / 'src' / header_file, include_directory)
+        jobs.append((file, doc_directory / file.name))
+    # Single pass over the source directory for binaries and headers.
+    found_headers: Set[str] = set()
+    with os.scandir(build_directory / 'src') as entries:
+        for entry in entries:
+            if entry.name.endswith(('.exe', '.dll')):
+                jobs.append((entry.path, bin_directory / entry.name))
+            elif entry.name in HEADERS:
+                jobs.append((entry.path, include_directory / entry.name))
+                found_headers.add(entry.name)
+    missing_headers: Final[List[str]] = sorted(HEADERS - found_headers)
+    if missing_headers:
+        raise SystemExit(f'Missing Lua headers: {", ".join(missing_headers)}.')
+
+    def copy(job: Tuple[Union[str, Path], Path]) -> None:
+        file, destination = job
+        logger.info(f'Copying file: {file!s} -> {destination!s}')
+        # Metadata isn't needed, so skip `copy2`'s `copystat` and only copy
+        # contents (using the platform's fast copy, where available).
+        shutil.copyfile(file, destination)
+
+    # Copying is I/O bound, so the copies can run concurrently.
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(copy, jobs))
 
 
 def install_lua(dist_directory: Path, install_directory: Path) -> None:
-    """Install Lua."""
+    """Install Lua.
+
+    The distribution is moved into place when it is on the same volume as the
+    install directory, otherwise it is copied.
+    """
     logger.info(
         f'Installing Lua to {install_directory!s} from {dist_directory!s}'
     )
+    install_directory.parent.mkdir(parents=True, exist_ok=True)
+    same_volume: Final[bool] = (
+        os.stat(dist_directory).st_dev
+        == os.stat(install_directory.parent).st_dev
+    )
+    old_directory: Final[Path] = install_directory.with_suffix('.old')
+    if old_directory.exists():
+        force_rmtree(old_directory)
     if install_directory.exists():
-        shutil.rmtree(install_directory)
-    shutil.copytree(dist_directory, install_directory)
+        os.replace(install_directory, old_directory)
 
+    try:
+        if same_volume:
+            os.replace(dist_directory, install_directory)
+        else:
+            logger.info('Dist directory is on another volume, copying.')
+            shutil.copytree(
+                dist_directory, install_directory, copy_function=shutil.copy
+            )
+    except BaseException:
+        # Remove any partial copy, and restore the previous installation.
+        if install_directory.exists():
+            force_rmtree(install_directory)
+        if old_directory.exists():
+            os.replace(old_directory, install_directory)
+        raise
+
+    if old_directory.exists():
+        force_rmtree(old_directory)
+
+
+def parse_args(argv: Optional[Sequence[str]] = None) -> argparse.Namespace:
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().splitlines()[0]
+    )
+    parser.add_argument(
+        '--cache',
+        action='store_true',
+        help='keep the downloaded archive for later runs',
+    )
+    return parser.parse_args(argv)
 
-def main() -> int:
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+
+    args: Final[argparse.Namespace] = parse_args(argv)
+
+    listener = configure_logging()
+    atexit.register(listener.stop)
 
     build_directory: Final[Path] = Path(f'lua-{version}')
     distribution_directory: Final[Path] = Path('dist') / f'lua-{version}'
 
     check_dependencies()
 
-    clean_lua_source()
+    # Reuse the existing source tree when it was already built; make's
+    # dependency tracking makes the rebuild a no-op.
+    if is_built(build_directory, version):
+        logger.info(f'Reusing Lua {version} source: {build_directory!s}')
+    else:
+        clean_lua_source()
 
-    archive: Final[Path] = download_lua(version)
-    extract_lua(archive)
+        if args.cache:
+            archive: Final[Path] = download_lua(version)
+            extract_lua(archive)
+        else:
+            fetch_and_extract(version)
 
+    prefetch_thread = prefetch_source(build_directory)
     build_lua(build_directory)
-    lua_build_executable: Final[str] = str(build_directory / 'src' / 'lua')
-    check_lua(lua_build_executable)
+    prefetch_thread.join()
+    mark_built(build_directory, version)
+    lua_build_executable: Final[Path] = build_directory / 'src' / 'lua'
+    # Let the built Lua start up while the distribution is created.
+    lua_build_process = start_executable(lua_build_executable)
 
     clean_distribution(distribution_directory)
     create_distribution(build_directory, distribution_directory)
-    lua_dist_executable: Final[str] = str(
-        distribution_directory / 'bin' / 'lua'
-    )
-    check_lua(lua_dist_executable)
+    check_lua(lua_build_executable, lua_build_process)
+    lua_dist_executable: Final[Path] = distribution_directory / 'bin' / 'lua'
+    check_lua(lua_dist_executable, start_executable(lua_dist_executable))
 
     install_lua(distribution_directory, install_directory)
 
@@ -1,11 +1,22 @@
 import logging
+import logging.config
+import logging.handlers
+import queue
 from pathlib import Path
 
 
 logs_path = Path(__file__).parent.parent / 'logs'
-logs_path.mkdir(exist_ok=True)
 log_file = logs_path / Path(__file__).with_suffix('.log').name
 
+
+class LazyFileHandler(logging.FileHandler):
+    """File handler creating the log directory on first write."""
+
+    def _open(self):
+        Path(self.baseFilename).parent.mkdir(parents=True, exist_ok=True)
+        return super()._open()
+
+
 LOGGING_CONFIG = dict(
     version=1,
     disable_existing_loggers=False,
@@ -32,10 +43,33 @@ LOGGING_CONFIG = dict(
         },
         'file_handler': {
             'level': logging.DEBUG,
-            'class': 'logging.FileHandler',
+            'class': f'{__name__}.LazyFileHandler',
             'formatter': 'default',
             'filename': log_file,
+            'delay': True,
         },
     },
     loggers={},
 )
+
+
+def configure_logging() -> logging.handlers.QueueListener:
+    """Configure logging, writing records from a background thread.
+
+    The root logger only enqueues records, while the returned (started)
+    listener drains them to the configured handlers. Stop the listener before
+    exiting to flush any remaining records.
+    """
+    logging.config.dictConfig(LOGGING_CONFIG)
+    root = logging.getLogger()
+    handlers = list(root.handlers)
+    log_queue: queue.Queue = queue.Queue(-1)
+    for handler in handlers:
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+
+    listener = logging.handlers.QueueListener(
+        log_queue, *handlers, respect_handler_level=True
+    )
+    listener.start()
+    return listener